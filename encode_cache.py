@@ -0,0 +1,197 @@
+'''Кэш результатов кодирования по содержимому исходных файлов.
+
+Повторный инжест тех же клипов с теми же параметрами ffmpeg (например, после
+исправления названия сюжета или ФИО журналиста) не запускает кодирование заново:
+готовый mxf берётся из кэша через reflink, жёсткую ссылку или копию.
+
+Переданный в mxf_target_folder файл никогда не делит данные с записью кэша:
+жёсткая ссылка используется, только если перенос в mxf_target_folder идёт на другой том
+(и shutil.move всё равно сделает независимую копию), иначе - reflink или обычная копия.
+
+Ключ - хэш упорядоченного списка отпечатков клипов и профиля кодирования.
+Кэш лежит на томе инжеста, его размер ограничен, старые записи вытесняются (LRU).'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+
+CACHE_DIR_NAME = '.encode_cache'
+CACHE_EXT = '.mxf'
+TMP_EXT = '.tmp'
+
+# Временные файлы старше этого срока остались от прерванного сохранения (идущее копирование их обновляет)
+STALE_TMP_SECONDS = 3600
+
+# Отпечаток клипа: размер и выборка блоков по всему файлу вместо полного чтения
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_BLOCK = 1024 * 1024
+
+# ioctl FICLONE (linux/fs.h) - копирование по ссылке на btrfs/xfs
+FICLONE = 0x40049409
+
+DEFAULT_MAX_GB = 200
+
+
+def fingerprint_file(path):
+    '''Отпечаток клипа по размеру и FINGERPRINT_SAMPLES блокам, равномерно взятым из файла.'''
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, 'big'))
+    with open(path, 'rb') as f:
+        if size <= FINGERPRINT_SAMPLES * FINGERPRINT_BLOCK:
+            for block in iter(lambda: f.read(FINGERPRINT_BLOCK), b''):
+                digest.update(block)
+        else:
+            step = (size - FINGERPRINT_BLOCK) // (FINGERPRINT_SAMPLES - 1)
+            for i in range(FINGERPRINT_SAMPLES):
+                f.seek(i * step)
+                digest.update(f.read(FINGERPRINT_BLOCK))
+    return digest.hexdigest()
+
+
+def reflink(src, dst):
+    '''Копия по ссылке (copy-on-write). Поддерживается только на Linux.'''
+    if not sys.platform.startswith('linux'):
+        raise OSError('reflink не поддерживается на этой системе')
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def link_or_copy(src, dst, allow_hardlink=False):
+    '''Создаёт dst из src: reflink, затем жёсткая ссылка (если разрешена), затем обычное копирование.
+
+    Возвращает способ, которым создан файл.'''
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except OSError:
+        pass
+    if allow_hardlink:
+        try:
+            os.link(src, dst)
+            return 'жёсткая ссылка'
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return 'копия'
+
+
+class EncodeCache:
+    '''Ограниченный по размеру кэш готовых mxf с вытеснением давно не использованных.'''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock() # Задания демона работают с кэшем параллельно
+
+    @classmethod
+    def from_settings(cls, settings, ingest_root_path):
+        '''Создаёт кэш по разделу [settings]. Возвращает None, если кэш отключён.'''
+        max_gb = settings.getfloat('encode_cache_max_gb', DEFAULT_MAX_GB)
+        if max_gb <= 0 or not ingest_root_path:
+            return None
+        cache_dir = settings.get('encode_cache_dir') or os.path.join(ingest_root_path, CACHE_DIR_NAME)
+        return cls(cache_dir, int(max_gb * 1024 ** 3))
+
+    def make_key(self, source_files, profile):
+        '''Ключ записи: отпечатки клипов в порядке склейки и профиль кодирования.'''
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(json.dumps(profile, ensure_ascii=False).encode('utf-8'))
+        for path in source_files:
+            digest.update(fingerprint_file(path).encode('ascii'))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_EXT)
+
+    def hardlink_is_safe(self, target_path):
+        '''Жёсткая ссылка допустима, только если перенос в target_path будет копированием на другой том.
+
+        Иначе переданный редакторам файл оказался бы самой записью кэша.'''
+        if not target_path:
+            return False
+        try:
+            target_dir = os.path.dirname(os.path.abspath(target_path))
+            return os.stat(target_dir).st_dev != os.stat(self.cache_dir).st_dev
+        except OSError:
+            return False
+
+    def touch(self, entry):
+        '''Отмечает использование записи для LRU через время доступа, не трогая время изменения.'''
+        stat = os.stat(entry)
+        os.utime(entry, ns=(time.time_ns(), stat.st_mtime_ns))
+
+    def fetch(self, key, output_path, target_path=None):
+        '''Создаёт output_path из кэша. Возвращает способ создания или None при промахе.
+
+        target_path - куда затем будет перенесён output_path.
+        Блокировка держится только на проверку записи: копирование многогигабайтного mxf
+        одного задания не должно задерживать обращения к кэшу других заданий.'''
+        entry = self.entry_path(key)
+        with self.lock:
+            if not os.path.isfile(entry):
+                return None
+            self.touch(entry) # Только что использованная запись вытесняется последней
+        try:
+            return link_or_copy(entry, output_path, self.hardlink_is_safe(target_path))
+        except FileNotFoundError:
+            return None # Запись вытеснена, пока мы до неё добирались
+
+    def store(self, key, output_path, target_path=None):
+        '''Помещает проверенный результат кодирования в кэш и вытесняет лишнее.'''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = self.entry_path(key)
+        tmp_path = f'{entry}.{os.getpid()}.{threading.get_ident()}{TMP_EXT}'
+        try:
+            link_or_copy(output_path, tmp_path, self.hardlink_is_safe(target_path))
+            with self.lock:
+                os.replace(tmp_path, entry)
+                self.touch(entry)
+                self.evict()
+        except Exception:
+            # Недописанная копия (например, при нехватке места) не должна оставаться в кэше
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def evict(self):
+        '''Удаляет брошенные временные файлы и самые давно использованные записи, пока кэш больше max_bytes.'''
+        entries = []
+        total = 0
+        stale_before = time.time() - STALE_TMP_SECONDS
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(TMP_EXT):
+                try:
+                    if entry.stat().st_mtime < stale_before:
+                        os.remove(entry.path)
+                except OSError as e:
+                    print(f'Не удалось удалить временный файл кэша {entry.path}: {e}')
+                continue
+            if not entry.name.endswith(CACHE_EXT):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError as e:
+                print(f'Не удалось удалить запись кэша {path}: {e}')
@@ -0,0 +1,286 @@
+'''Общие шаги инжеста: копирование MTS, список для склейки, команда ffmpeg и проверка mxf.
+
+Используются и формой (main.py), и режимом наблюдения за папками (watch_daemon.py),
+чтобы оба пути давали одинаковый результат.'''
+
+import os
+import re
+import sys
+import time
+import codecs
+import shutil
+import subprocess
+
+import metrics
+import mxf_validator
+
+
+# Путь к ffmpeg по умолчанию (можно переопределить параметром ffmpeg_path в config.ini)
+FFMPEG_PATH = r'./ffmpeg/bin/ffmpeg.exe'
+
+# Параметры выходного mxf, по ним же проверяется результат
+MXF_FRAME_RATE = 25
+MXF_AUDIO_TRACKS = 8 # По числу pan в filter_complex
+
+# Шаблон имён файлов MTS с камеры: 0000.mts
+MTS_PATTERN = re.compile(r'^\d{4}\.mts$', re.IGNORECASE)
+
+# Строка прогресса ffmpeg -stats: frame=  250 fps= 48 ... speed=1.92x
+FFMPEG_FRAME = re.compile(r'frame=\s*(\d+)')
+FFMPEG_FPS = re.compile(r'fps=\s*([\d.]+)')
+FFMPEG_SPEED = re.compile(r'speed=\s*([\d.]+)x')
+
+# Символы, недопустимые в именах папок и файлов Windows
+INVALID_NAME_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+
+def list_mts_files(directory):
+    '''Возвращает отсортированный список файлов MTS в папке.'''
+    return sorted(f for f in os.listdir(directory) if MTS_PATTERN.match(f))
+
+
+def make_folder_name(day_month, journalist, story):
+    '''Имя папки инжеста: ДДММ Фамилия Название сюжета'''
+    folder_name = f'{day_month} {journalist} {story}'
+    return INVALID_NAME_CHARS.sub('_', folder_name).strip(' .')
+
+
+def copy_files(files_to_copy, source_dir, dest_dir):
+    '''Копирует файлы из source_dir в dest_dir с сохранением дат.'''
+    started = time.monotonic()
+    metrics.JOBS_IN_PROGRESS.inc(stage='copy')
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+        for filename in files_to_copy:
+            src = os.path.join(source_dir, filename)
+            dst = os.path.join(dest_dir, filename)
+            file_started = time.monotonic()
+            shutil.copy2(src, dst)
+            size = os.path.getsize(dst)
+            metrics.COPIED_BYTES_TOTAL.inc(size)
+            metrics.COPY_THROUGHPUT.set(size / max(time.monotonic() - file_started, 1e-6))
+    except Exception:
+        metrics.ERRORS_TOTAL.inc(stage='copy')
+        raise
+    finally:
+        metrics.JOBS_IN_PROGRESS.dec(stage='copy')
+        metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='copy')
+
+
+def write_concat_file(concat_file_path, dest_folder, files):
+    '''Создаёт файл списка для concat-демультиплексора ffmpeg.'''
+    with open(concat_file_path, 'w', encoding='utf-8') as f:
+        for filename in files:
+            full_path = os.path.join(dest_folder, filename)
+            f.write(f"file '{full_path}'\n")
+
+
+def build_ffmpeg_cmd(concat_file_path, output_file_path, ffmpeg_path=FFMPEG_PATH):
+    '''Формирует команду ffmpeg для кодирования склейки в XDCAM HD422 mxf.'''
+    return [
+        ffmpeg_path,
+        "-y",
+        "-safe", "0",
+        "-f", "concat",
+        "-i", concat_file_path,
+        "-loglevel", "repeat+error",
+        "-stats",
+        "-filter_complex", "[v]format=yuv422p,scale=1920x1080;"
+                           "[a]pan=1|c0=c0;"
+                           "[a]pan=1|c0=c1;"
+                           "[a]pan=1|c0=c2;"
+                           "[a]pan=1|c0=c3;"
+                           "[a]pan=1|c0=c4;"
+                           "[a]pan=1|c0=c5;"
+                           "[a]pan=1|c0=c6;"
+                           "[a]pan=1|c0=c7",
+        "-minrate", "50M",
+        "-maxrate", "50M",
+        "-dc", "10",
+        "-intra_vlc", "1",
+        "-non_linear_quant", "1",
+        "-lmin", "1*QP2LAMBDA",
+        "-rc_max_vbv_use", "1",
+        "-rc_min_vbv_use", "1",
+        "-qmin", "1",
+        "-qmax", "12",
+        "-vtag", "xd5e",
+        "-vminrate", "50M",
+        "-f", "mxf",
+        "-c:a", "pcm_s24le",
+        "-ac", "1",
+        "-ar", "48000",
+        "-ab", "384k",
+        "-c:v", "mpeg2video",
+        "-vb", "50M",
+        "-vmaxrate", "50M",
+        "-vbufsize", "36408360",
+        "-g", "12",
+        "-bf", "2",
+        "-aspect", "1.77778",
+        "-top", "1",
+        "-alternate_scan", "1",
+        "-r", str(MXF_FRAME_RATE),
+        "-threads", "3",
+        output_file_path
+    ]
+
+
+def run_ffmpeg(ffmpeg_cmd, on_start=None, is_stopped=None):
+    '''Запускает ffmpeg и читает его прогресс (-stats) по мере кодирования.
+
+    on_start(process) вызывается сразу после запуска - например, чтобы процесс можно было прервать.
+    is_stopped() сообщает, что процесс остановил пользователь: такой выход не считается ошибкой.
+    Возвращает (код возврата, сообщения ffmpeg без строк прогресса).'''
+    creationflags = 0
+    if sys.platform == "win32":
+        creationflags = subprocess.CREATE_NO_WINDOW
+
+    # Метка задания для рядов прогресса: папка инжеста и имя mxf (папки уникальны)
+    output_path = ffmpeg_cmd[-1]
+    job = os.path.join(os.path.basename(os.path.dirname(output_path)), os.path.basename(output_path))
+
+    started = time.monotonic()
+    metrics.JOBS_IN_PROGRESS.inc(stage='encode')
+    # Отсчёт зависания начинается с запуска, даже если ffmpeg не выдал ни одной строки прогресса
+    metrics.FFMPEG_LAST_PROGRESS.set(time.time(), job=job)
+    try:
+        process = subprocess.Popen(
+            ffmpeg_cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            creationflags=creationflags
+        )
+        if on_start:
+            on_start(process)
+
+        messages = []
+        last_frame = 0
+        buffer = ''
+        # Многобайтовый символ UTF-8 (кириллица в путях) может разорваться между блоками
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            chunk = process.stderr.read1(4096)
+            if not chunk:
+                buffer += decoder.decode(b'', final=True)
+                break
+            # Строки прогресса ffmpeg разделяются \r, сообщения - \n
+            buffer += decoder.decode(chunk)
+            *lines, buffer = re.split(r'[\r\n]', buffer)
+            for line in lines:
+                if 'speed=' not in line:
+                    if line.strip():
+                        messages.append(line)
+                    continue
+                frame = FFMPEG_FRAME.search(line)
+                if frame and int(frame.group(1)) > last_frame:
+                    metrics.ENCODED_FRAMES_TOTAL.inc(int(frame.group(1)) - last_frame)
+                    last_frame = int(frame.group(1))
+                fps = FFMPEG_FPS.search(line)
+                if fps:
+                    metrics.ENCODE_FPS.set(float(fps.group(1)), job=job)
+                speed = FFMPEG_SPEED.search(line)
+                if speed:
+                    metrics.FFMPEG_SPEED.set(float(speed.group(1)), job=job)
+                metrics.FFMPEG_LAST_PROGRESS.set(time.time(), job=job)
+        if buffer.strip() and 'speed=' not in buffer:
+            messages.append(buffer)
+        returncode = process.wait()
+    except Exception:
+        metrics.ERRORS_TOTAL.inc(stage='encode')
+        raise
+    finally:
+        metrics.JOBS_IN_PROGRESS.dec(stage='encode')
+        metrics.ENCODE_FPS.remove(job=job)
+        metrics.FFMPEG_SPEED.remove(job=job)
+        metrics.FFMPEG_LAST_PROGRESS.remove(job=job)
+        metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='encode')
+
+    if returncode != 0 and not (is_stopped and is_stopped()):
+        metrics.ERRORS_TOTAL.inc(stage='encode')
+    return returncode, '\n'.join(messages)
+
+
+def move_output(output_path, target_path):
+    '''Переносит готовый mxf в папку назначения.'''
+    started = time.monotonic()
+    try:
+        size = os.path.getsize(output_path)
+        shutil.move(output_path, target_path)
+    except Exception:
+        metrics.ERRORS_TOTAL.inc(stage='move')
+        raise
+    finally:
+        metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='move')
+    metrics.OUTPUT_BYTES_TOTAL.inc(size)
+
+
+def validate_output(output_path, source_files=None,
+                    frame_rate=MXF_FRAME_RATE, audio_tracks=MXF_AUDIO_TRACKS):
+    '''Быстрая проверка структуры mxf, числа кадров и звуковых дорожек.
+
+    Если длительность исходных файлов определить нельзя (повреждённый или неполный источник),
+    число кадров не с чем сверить, и проверка не пройдена.
+    Возвращает (успех, сообщение).'''
+    started = time.monotonic()
+    expected_frames = None
+    tolerance = 0
+    valid, message = True, ''
+    if source_files:
+        try:
+            expected_frames = mxf_validator.expected_frame_count(source_files, frame_rate)
+            tolerance = mxf_validator.FRAME_TOLERANCE_PER_CLIP * len(source_files)
+        except (OSError, mxf_validator.MxfValidationError) as e:
+            valid = False
+            message = (f'Проверка {os.path.basename(output_path)} не пройдена: '
+                       f'не удалось определить длительность исходных файлов ({e})')
+    if valid:
+        valid, message = mxf_validator.validate_mxf(output_path,
+                                                    expected_frames=expected_frames,
+                                                    audio_tracks=audio_tracks,
+                                                    edit_rate=(frame_rate, 1),
+                                                    tolerance=tolerance)
+    metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='validate')
+    if not valid:
+        metrics.ERRORS_TOTAL.inc(stage='validate')
+    return valid, message
+
+
+def encode_profile(ffmpeg_path=FFMPEG_PATH):
+    '''Параметры кодирования без путей к конкретным файлам - часть ключа кэша.'''
+    return build_ffmpeg_cmd('<concat>', '<output>', ffmpeg_path)
+
+
+def remove_stale_output(output_path):
+    '''Удаляет прежний результат перед кодированием.
+
+    Он может быть жёсткой ссылкой на запись кэша, и ffmpeg -y перезаписал бы её содержимое.'''
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+
+def fetch_cached_output(encode_cache, source_files, ffmpeg_path, output_path, target_path):
+    '''Ищет готовый mxf в кэше. Возвращает (ключ, способ создания или None).
+
+    target_path - куда output_path будет перенесён (от этого зависит, можно ли делить файл с кэшем).'''
+    if encode_cache is None or not source_files:
+        return None, None
+    try:
+        key = encode_cache.make_key(source_files, encode_profile(ffmpeg_path))
+        method = encode_cache.fetch(key, output_path, target_path)
+        if method:
+            metrics.CACHE_HITS_TOTAL.inc()
+        return key, method
+    except OSError as e:
+        print(f'Кэш кодирования недоступен: {e}')
+        return None, None
+
+
+def store_cached_output(encode_cache, key, output_path, target_path):
+    '''Сохраняет проверенный mxf в кэш. Ошибки кэша не прерывают инжест.'''
+    if encode_cache is None or key is None:
+        return
+    try:
+        encode_cache.store(key, output_path, target_path)
+    except OSError as e:
+        print(f'Не удалось сохранить результат в кэш кодирования: {e}')
@@ -1,7 +1,6 @@
 import os
-import re
 import sys
-import shutil
+import time
 import tempfile
 import subprocess
 import configparser
@@ -19,6 +18,9 @@ from PyQt5.QtGui import QIcon # Для иконок
 
 from form import IngestForm
 from datetime import datetime
+import ingest_pipeline
+from encode_cache import EncodeCache
+import metrics
 
 
 class AlignCenterDelegate(QStyledItemDelegate):
@@ -73,11 +75,7 @@ class CopyFilesWorker(QThread):
 
     def run(self):
         try:
-            os.makedirs(self.dest_dir, exist_ok=True)
-            for filename in self.files_to_copy:
-                src = os.path.join(self.source_dir, filename)
-                dst = os.path.join(self.dest_dir, filename)
-                shutil.copy2(src, dst)
+            ingest_pipeline.copy_files(self.files_to_copy, self.source_dir, self.dest_dir)
             self.finished.emit(True, 'Копирование завершено успешно.')
         except Exception as e:
             self.finished.emit(False, f'Ошибка копирования: {e}')
@@ -87,39 +85,52 @@ class FFmpegWorker(QThread):
     '''Поток для выполнения ffmpeg, чтобы не блокировать GUI'''
     finished = pyqtSignal(bool, str)  # успех, сообщение
     
-    def __init__(self, ffmpeg_cmd, output_path, move_to_path):
+    def __init__(self, ffmpeg_cmd, output_path, move_to_path, source_files=None,
+                 encode_cache=None, ffmpeg_path=ingest_pipeline.FFMPEG_PATH):
         super().__init__()
         self.ffmpeg_cmd = ffmpeg_cmd
         self.output_path = output_path
         self.move_to_path = move_to_path
+        self.source_files = source_files # Исходные MTS для проверки длительности mxf
+        self.encode_cache = encode_cache # Кэш готовых mxf (None - отключён)
+        self.ffmpeg_path = ffmpeg_path
         self.process = None  # Добавляем атрибут для хранения объекта процесса
+        self.stopped = False # ffmpeg остановлен пользователем (не считается ошибкой в метриках)
 
     def run(self):
-        creationflags = 0
-        if sys.platform == "win32":
-            creationflags = subprocess.CREATE_NO_WINDOW
-
         try:
-            self.process = subprocess.Popen(
-                self.ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True, # Декодировать stdout/stderr как текст
-                encoding='utf-8',
-                creationflags=creationflags
-            )
-
-            # Ожидаем завершения процесса и получаем stdout/stderr
-            stdout, stderr = self.process.communicate()
+            # Те же клипы с тем же профилем уже кодировались - берём mxf из кэша
+            cache_key, cache_method = ingest_pipeline.fetch_cached_output(
+                self.encode_cache, self.source_files, self.ffmpeg_path, self.output_path, self.move_to_path)
+
+            if cache_method:
+                returncode, stderr = 0, ''
+            else:
+                ingest_pipeline.remove_stale_output(self.output_path)
+                # Ожидаем завершения процесса, по пути обновляя метрики прогресса
+                returncode, stderr = ingest_pipeline.run_ffmpeg(
+                    self.ffmpeg_cmd, on_start=lambda process: setattr(self, 'process', process),
+                    is_stopped=lambda: self.stopped)
             
-            if self.process.returncode == 0:
+            if returncode == 0:
+                # Проверяем mxf до переноса: код 0 не гарантирует целый файл
+                valid, message = ingest_pipeline.validate_output(self.output_path, self.source_files)
+                if not valid:
+                    self.finished.emit(False, message)
+                    return
+                if not cache_method:
+                    ingest_pipeline.store_cached_output(self.encode_cache, cache_key, self.output_path,
+                                                        self.move_to_path)
                 try:
-                    shutil.move(self.output_path, self.move_to_path)
-                    self.finished.emit(True, "Кодирование и перенос завершены успешно.")
+                    ingest_pipeline.move_output(self.output_path, self.move_to_path)
+                    if cache_method:
+                        self.finished.emit(True, f"Результат взят из кэша кодирования ({cache_method}) и перенесён.")
+                    else:
+                        self.finished.emit(True, "Кодирование и перенос завершены успешно.")
                 except Exception as e:
                     self.finished.emit(False, f"Кодирование завершено, но не удалось переместить файл mxf:\n{e}")
             else:
-                self.finished.emit(False, f"FFmpeg вернул ошибку:\n{result.stderr}")
+                self.finished.emit(False, f"FFmpeg вернул ошибку:\n{stderr}")
         except Exception as e:
             self.finished.emit(False, f"Ошибка запуска ffmpeg:\n{e}")
 
@@ -130,6 +141,7 @@ class FFmpegWorker(QThread):
         Вызывается извне, например, при закрытии окна.
         '''
         if self.process and self.process.poll() is None:  # Если процесс еще жив
+            self.stopped = True
             self.process.terminate()  # Посылаем запрос на завершение процесса
             try:
                 self.process.wait(timeout=5)  # Ждем до 5 секунд завершения
@@ -145,6 +157,8 @@ class IngestFormMain(IngestForm):
 
         self.config = configparser.ConfigParser()
         self.ini_path = 'journalists.ini'
+        self.ffmpeg_path = ingest_pipeline.FFMPEG_PATH
+        self.encode_cache = None
         self.directory = None # Путь к папке MTS на флешке
         # self.directory_ingest = None # Больше не нужен, путь инжеста из конфига
         self.now = datetime.now()
@@ -152,6 +166,10 @@ class IngestFormMain(IngestForm):
         
         # Загружаем путь для инжеста из config.ini
         self.load_ingest_config()
+
+        # Необязательный HTTP-сервер метрик (раздел [metrics] в config.ini)
+        self.metrics_server = metrics.start_from_config(self.config)
+        self.job_started_at = None # Начало текущего инжеста для метрик
         
         # Удаляем comboJournalists из вертикального лэйаута,
         # чтобы потом добавить в горизонтальный лэйаут вместе с кнопкой
@@ -231,6 +249,8 @@ class IngestFormMain(IngestForm):
             if 'settings' in self.config:
                 self.ingest_root_path = self.config['settings'].get('ingest_root_path')
                 self.mxf_target_folder = self.config['settings'].get('mxf_target_folder')
+                self.ffmpeg_path = self.config['settings'].get('ffmpeg_path', ingest_pipeline.FFMPEG_PATH)
+                self.encode_cache = EncodeCache.from_settings(self.config['settings'], self.ingest_root_path)
                 if not self.ingest_root_path or not self.mxf_target_folder:
                     QMessageBox.critical(self, 'Ошибка конфигурации',
                                          'В config.ini должны быть указаны ingest_root_path и mxf_target_folder')
@@ -267,8 +287,7 @@ class IngestFormMain(IngestForm):
         if os.path.isdir(mts_folder_path):
             try:
                 # Фильтруем файлы по расширению .mts и паттерну 0000.mts
-                pattern = re.compile(r'^\d{4}\.mts$', re.IGNORECASE)
-                found_files = [f for f in os.listdir(mts_folder_path) if pattern.match(f)]
+                found_files = ingest_pipeline.list_mts_files(mts_folder_path)
             except Exception as e:
                 print(f'Ошибка чтения содержимого {mts_folder_path}: {e}')
         return mts_folder_path, found_files
@@ -441,7 +460,7 @@ class IngestFormMain(IngestForm):
             QMessageBox.warning(self, 'Ошибка', 'Введите ФИО журналиста и название сюжета.')
             return
 
-        folder_name = f'{day_month} {journalist} {story}'
+        folder_name = ingest_pipeline.make_folder_name(day_month, journalist, story)
         
         # Используем путь из конфига
         dest_folder = os.path.join(self.ingest_root_path, folder_name)
@@ -464,6 +483,7 @@ class IngestFormMain(IngestForm):
         
         # Запскаем таймер для копирования
         self.start_main_timer()
+        self.job_started_at = time.monotonic()
 
         # Запускаем копирование в отдельном потоке
         self.worker_copy = CopyFilesWorker(files_to_copy, self.selected_directory, dest_folder)
@@ -481,6 +501,7 @@ class IngestFormMain(IngestForm):
             self.labelStatus.setStyleSheet("background-color: red; color: white;")
             self.labelStatus.setText(msg)
             self.buttonIngest.setEnabled(True)
+            self.finish_job_metrics('failure')
             return
 
         self.labelStatus.setText("Копирование завершено, подготовка к кодированию...")
@@ -490,12 +511,10 @@ class IngestFormMain(IngestForm):
         concat_file_path = os.path.join(tmp_dir, 'concat.txt')
 
         try:
-            with open(concat_file_path, 'w', encoding='utf-8') as f:
-                for filename in files_to_copy:
-                    full_path = os.path.join(dest_folder, filename)
-                    f.write(f"file '{full_path}'\n")
+            ingest_pipeline.write_concat_file(concat_file_path, dest_folder, files_to_copy)
         except Exception as e:
             QMessageBox.critical(self, 'Ошибка', f'Не удалось создать concat.txt: {e}')
+            self.finish_job_metrics('failure')
             return
 
         self.labelStatus.setText('Копирование и подготовка завершены. Готово.')
@@ -505,9 +524,6 @@ class IngestFormMain(IngestForm):
 
         QApplication.processEvents()
 
-        # Путь к ffmpeg (укажите реальный путь к ffmpeg.exe на вашем компьютере)
-        ffmpeg_path = r'./ffmpeg/bin/ffmpeg.exe'
-
         # Путь к файлу concat.txt (список файлов для конкатенации)
         concat_file_path = os.path.join(tmp_dir, 'concat.txt')
 
@@ -517,59 +533,19 @@ class IngestFormMain(IngestForm):
         target_path = os.path.join(self.mxf_target_folder, output_filename)
 
         # Формируем команду ffmpeg
-        ffmpeg_cmd = [
-            ffmpeg_path,
-            "-y",
-            "-safe", "0",
-            "-f", "concat",
-            "-i", concat_file_path,
-            "-loglevel", "repeat+error",
-            "-stats",
-            "-filter_complex", "[v]format=yuv422p,scale=1920x1080;"
-                               "[a]pan=1|c0=c0;"
-                               "[a]pan=1|c0=c1;"
-                               "[a]pan=1|c0=c2;"
-                               "[a]pan=1|c0=c3;"
-                               "[a]pan=1|c0=c4;"
-                               "[a]pan=1|c0=c5;"
-                               "[a]pan=1|c0=c6;"
-                               "[a]pan=1|c0=c7",
-            "-minrate", "50M",
-            "-maxrate", "50M",
-            "-dc", "10",
-            "-intra_vlc", "1",
-            "-non_linear_quant", "1",
-            "-lmin", "1*QP2LAMBDA",
-            "-rc_max_vbv_use", "1",
-            "-rc_min_vbv_use", "1",
-            "-qmin", "1",
-            "-qmax", "12",
-            "-vtag", "xd5e",
-            "-vminrate", "50M",
-            "-f", "mxf",
-            "-c:a", "pcm_s24le",
-            "-ac", "1",
-            "-ar", "48000",
-            "-ab", "384k",
-            "-c:v", "mpeg2video",
-            "-vb", "50M",
-            "-vmaxrate", "50M",
-            "-vbufsize", "36408360",
-            "-g", "12",
-            "-bf", "2",
-            "-aspect", "1.77778",
-            "-top", "1",
-            "-alternate_scan", "1",
-            "-r", "25",
-            "-threads", "3",
-            output_file_path
-        ]
+        ffmpeg_cmd = ingest_pipeline.build_ffmpeg_cmd(concat_file_path, output_file_path, self.ffmpeg_path)
 
         self.labelStatus.setText('Кодирование...')
         QApplication.processEvents()
 
+        # Исходные файлы для проверки длительности mxf
+        source_files = [os.path.join(dest_folder, filename) for filename in files_to_copy]
+
         # Запускаем кодирование в отдельном потоке
-        self.worker = FFmpegWorker(ffmpeg_cmd, output_file_path, target_path)
+        self.worker = FFmpegWorker(ffmpeg_cmd, output_file_path, target_path,
+                                   source_files=source_files,
+                                   encode_cache=self.encode_cache,
+                                   ffmpeg_path=self.ffmpeg_path)
         self.worker.finished.connect(self.on_encoding_finished)
         self.worker.start()
 
@@ -591,6 +567,8 @@ class IngestFormMain(IngestForm):
 
         #self.buttonIngest.setEnabled(True)    # разблокируем кнопку инжеста
         
+        self.finish_job_metrics('success' if success else 'failure')
+
         if success:
             self.labelStatus.setStyleSheet("background-color: green; color: white;")
         else:
@@ -600,6 +578,15 @@ class IngestFormMain(IngestForm):
         self.worker = None
     
     
+    def finish_job_metrics(self, result):
+        '''Учитывает завершение инжеста в метриках: результат и общую длительность.'''
+        if self.job_started_at is None:
+            return
+        metrics.STAGE_SECONDS.observe(time.monotonic() - self.job_started_at, stage='total')
+        metrics.JOBS_TOTAL.inc(result=result)
+        self.job_started_at = None
+
+
     def start_main_timer(self, label_title=""):
         self.elapsed_seconds = 0
         self.labelTimer.setText("00:00:00")
@@ -630,6 +617,8 @@ class IngestFormMain(IngestForm):
             self.worker_copy.terminate()
             self.worker_copy.wait(2000)
             self.worker_copy = None
+            # terminate() не выполняет finally в copy_files - сбрасываем этап вручную
+            metrics.JOBS_IN_PROGRESS.set(0, stage='copy')
             stopped = True
 
         if self.worker and self.worker.isRunning():
@@ -642,6 +631,7 @@ class IngestFormMain(IngestForm):
         self.buttonIngest.setEnabled(True)
 
         if stopped:
+            self.finish_job_metrics('stopped')
             self.labelStatus.setStyleSheet("background-color: red; color: white;")
             self.labelStatus.setText("Операция остановлена пользователем.")
         
@@ -0,0 +1,192 @@
+'''Метрики станции инжеста в текстовом формате Prometheus.
+
+Счётчики обновляются всегда (это дёшево), а HTTP-сервер запускается,
+только если в config.ini в разделе [metrics] указано enabled = yes.
+Сторонние библиотеки не нужны: используется http.server из стандартной библиотеки.'''
+
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 9101
+
+# Границы корзин гистограмм длительности этапов, секунды (копирование и кодирование идут минутами)
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    '''Общая часть метрик: имя, описание, метки и блокировка.'''
+    kind = ''
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    '''Монотонно растущий счётчик.'''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''Значение, которое может расти и уменьшаться.'''
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def remove(self, **labels):
+        '''Удаляет ряд с указанными метками (например, по окончании задания).'''
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+
+class Histogram(Metric):
+    '''Гистограмма с накопительными корзинами, суммой и количеством.'''
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                labels = format_labels(self.label_names + ('le',), key + (format_value(bound),))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {counts[-1]}')
+        return lines
+
+
+REGISTRY = []
+
+QUEUE_DEPTH = Gauge('ingest_queue_depth', 'Поступления, ожидающие инжеста.')
+JOBS_IN_PROGRESS = Gauge('ingest_jobs_in_progress', 'Задания инжеста на каждом этапе.', ['stage'])
+JOBS_TOTAL = Counter('ingest_jobs_total', 'Завершённые задания инжеста по результату.', ['result'])
+ERRORS_TOTAL = Counter('ingest_errors_total', 'Ошибки по этапам инжеста.', ['stage'])
+COPIED_BYTES_TOTAL = Counter('ingest_copied_bytes_total', 'Байт MTS скопировано с носителей.')
+COPY_THROUGHPUT = Gauge('ingest_copy_throughput_bytes_per_second', 'Скорость копирования последнего файла.')
+OUTPUT_BYTES_TOTAL = Counter('ingest_output_bytes_total', 'Байт готовых mxf передано в mxf_target_folder.')
+ENCODED_FRAMES_TOTAL = Counter('ingest_encoded_frames_total', 'Кадров закодировано ffmpeg.')
+# Ряды с меткой job существуют, пока идёт кодирование этого задания
+ENCODE_FPS = Gauge('ingest_encode_fps', 'Текущая скорость кодирования, кадров в секунду.', ['job'])
+FFMPEG_SPEED = Gauge('ingest_ffmpeg_speed', 'Текущий коэффициент скорости ffmpeg (speed=...x).', ['job'])
+FFMPEG_LAST_PROGRESS = Gauge('ingest_ffmpeg_last_progress_timestamp_seconds',
+                             'Время последней строки прогресса ffmpeg (Unix) - для обнаружения зависаний.',
+                             ['job'])
+CACHE_HITS_TOTAL = Counter('ingest_encode_cache_hits_total', 'Результаты, взятые из кэша кодирования.')
+STAGE_SECONDS = Histogram('ingest_stage_duration_seconds', 'Длительность этапов инжеста.', ['stage'])
+
+
+def render():
+    '''Все метрики в текстовом формате Prometheus.'''
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Не засоряем консоль запросами сборщика
+
+
+def start_server(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    '''Запускает HTTP-сервер метрик в фоновом потоке и возвращает его.'''
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
+
+
+def start_from_config(config):
+    '''Запускает сервер по разделу [metrics]. Возвращает сервер или None.'''
+    if 'metrics' not in config or not config['metrics'].getboolean('enabled', False):
+        return None
+    section = config['metrics']
+    host = section.get('host', DEFAULT_HOST)
+    port = section.getint('port', DEFAULT_PORT)
+    try:
+        server = start_server(host, port)
+    except OSError as e:
+        print(f'Не удалось запустить сервер метрик на {host}:{port}: {e}')
+        return None
+    print(f'Метрики доступны по адресу http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,398 @@
+'''Быстрая проверка готового файла MXF без декодирования эссенции.
+
+Разбираются только служебные структуры MXF (KLV): пакеты разделов,
+Random Index Pack, метаданные заголовка и сегменты индексной таблицы.
+Ожидаемое число кадров считается по PCR исходных файлов MTS,
+поэтому вся проверка занимает миллисекунды даже для многочасовых сюжетов.'''
+
+import os
+import struct
+
+
+# Общий префикс ключей SMPTE
+SMPTE_UL_PREFIX = bytes.fromhex('060e2b34')
+
+# Ключ пакета раздела: 06 0E 2B 34 02 05 01 01 0D 01 02 01 01 KK SS 00
+# KK - вид раздела (02 заголовок, 03 тело, 04 футер), SS - статус
+PARTITION_KEY_PREFIX = bytes.fromhex('060e2b34020501010d01020101')
+PARTITION_HEADER = 0x02
+PARTITION_BODY = 0x03
+PARTITION_FOOTER = 0x04
+PARTITION_STATUS_CLOSED_COMPLETE = 0x04
+
+RANDOM_INDEX_PACK_KEY = bytes.fromhex('060e2b34020501010d01020101110100')
+INDEX_SEGMENT_KEY = bytes.fromhex('060e2b34025301010d01020101100100')
+
+# Наборы метаданных заголовка: 06 0E 2B 34 02 53 01 01 0D 01 01 01 01 01 XX XX
+METADATA_SET_PREFIX = bytes.fromhex('060e2b34025301010d01010101')
+
+# Fill item: 06 0E 2B 34 01 01 01 VV 03 01 02 10 01 00 00 00 (VV - версия реестра)
+FILL_KEY_PREFIX = bytes.fromhex('060e2b34010101')
+FILL_KEY_SUFFIX = bytes.fromhex('0301021001000000')
+
+# Элементы эссенции Generic Container - признак окончания метаданных
+ESSENCE_KEY_PREFIX = bytes.fromhex('060e2b34010201010d010301')
+
+# Типы наборов дескрипторов (последние два байта ключа)
+VIDEO_DESCRIPTOR_TYPES = {
+    0x0127,  # GenericPictureEssenceDescriptor
+    0x0128,  # CDCIEssenceDescriptor
+    0x0129,  # RGBAEssenceDescriptor
+    0x0151,  # MPEG2VideoDescriptor
+}
+SOUND_DESCRIPTOR_TYPES = {
+    0x0142,  # GenericSoundEssenceDescriptor
+    0x0147,  # AES3PCMDescriptor
+    0x0148,  # WaveAudioDescriptor
+}
+
+# Статические локальные теги
+TAG_SAMPLE_RATE = 0x3001
+TAG_CONTAINER_DURATION = 0x3002
+TAG_STORED_WIDTH = 0x3203
+TAG_CHANNEL_COUNT = 0x3D07
+TAG_INDEX_START_POSITION = 0x3F0C
+TAG_INDEX_DURATION = 0x3F0D
+TAG_INDEX_SID = 0x3F06
+
+# Параметры транспортного потока MTS
+TS_SYNC_BYTE = 0x47
+TS_PACKET_SIZE = 188
+M2TS_PACKET_SIZE = 192
+PCR_CLOCK = 27000000
+PCR_WRAP = (1 << 33) * 300
+PCR_SCAN_BYTES = 2 * 1024 * 1024  # Сколько байт читать с начала и конца клипа
+
+# Допустимое расхождение числа кадров на каждый клип склейки
+FRAME_TOLERANCE_PER_CLIP = 2
+
+
+class MxfValidationError(Exception):
+    '''Файл MXF повреждён, обрезан или не соответствует ожиданиям.'''
+
+
+def read_ber_length(f):
+    '''Читает длину KLV в кодировке BER. Возвращает (длина, размер поля).'''
+    first = f.read(1)
+    if not first:
+        raise MxfValidationError('Неожиданный конец файла при чтении длины KLV')
+    first = first[0]
+    if first < 0x80:
+        return first, 1
+    count = first & 0x7F
+    data = f.read(count)
+    if len(data) != count or count == 0 or count > 8:
+        raise MxfValidationError('Некорректная длина KLV')
+    return int.from_bytes(data, 'big'), count + 1
+
+
+def read_klv_header(f):
+    '''Читает ключ и длину KLV. Возвращает (ключ, длина, размер заголовка) или None в конце файла.'''
+    key = f.read(16)
+    if not key:
+        return None
+    if len(key) != 16 or not key.startswith(SMPTE_UL_PREFIX):
+        raise MxfValidationError(f'Некорректный ключ KLV по смещению {f.tell() - len(key)}')
+    length, length_size = read_ber_length(f)
+    return key, length, 16 + length_size
+
+
+def is_fill_key(key):
+    return key.startswith(FILL_KEY_PREFIX) and key[8:] == FILL_KEY_SUFFIX
+
+
+def is_partition_key(key):
+    return key.startswith(PARTITION_KEY_PREFIX) and key[13] in (
+        PARTITION_HEADER, PARTITION_BODY, PARTITION_FOOTER)
+
+
+def iter_local_set(value):
+    '''Перебирает элементы локального набора (тег 2 байта, длина 2 байта).'''
+    pos = 0
+    while pos + 4 <= len(value):
+        tag, length = struct.unpack_from('>HH', value, pos)
+        pos += 4
+        yield tag, value[pos:pos + length]
+        pos += length
+
+
+def parse_partition_pack(key, value, offset):
+    '''Разбирает пакет раздела MXF.'''
+    if len(value) < 88:
+        raise MxfValidationError(f'Пакет раздела по смещению {offset} слишком короткий')
+    (this_partition, previous_partition, footer_partition,
+     header_byte_count, index_byte_count) = struct.unpack_from('>QQQQQ', value, 8)
+    return {
+        'offset': offset,
+        'kind': key[13],
+        'status': key[14],
+        'this_partition': this_partition,
+        'previous_partition': previous_partition,
+        'footer_partition': footer_partition,
+        'header_byte_count': header_byte_count,
+        'index_byte_count': index_byte_count,
+    }
+
+
+def read_partition(f, offset):
+    '''Читает пакет раздела по смещению и все следующие за ним метаданные и индексы.
+
+    Эссенция не читается: разбор останавливается на первом элементе
+    эссенции, следующем разделе или после HeaderByteCount + IndexByteCount байт.'''
+    f.seek(offset)
+    header = read_klv_header(f)
+    if header is None:
+        raise MxfValidationError(f'Раздел по смещению {offset} за концом файла')
+    key, length, _ = header
+    if not is_partition_key(key):
+        raise MxfValidationError(f'По смещению {offset} нет пакета раздела')
+    value = f.read(length)
+    if len(value) != length:
+        raise MxfValidationError(f'Пакет раздела по смещению {offset} обрезан')
+    partition = parse_partition_pack(key, value, offset)
+    partition['metadata_sets'] = []
+    partition['index_segments'] = []
+
+    budget = partition['header_byte_count'] + partition['index_byte_count']
+    consumed = 0
+    started = False
+    while consumed < budget:
+        header = read_klv_header(f)
+        if header is None:
+            raise MxfValidationError(f'Метаданные раздела по смещению {offset} обрезаны')
+        key, length, header_size = header
+        # Primer Pack (KK = 05) и RIP (KK = 11) начинаются с того же префикса, что и пакет раздела,
+        # поэтому останавливаемся только на настоящем разделе
+        if is_partition_key(key) or key.startswith(ESSENCE_KEY_PREFIX) \
+                or key == RANDOM_INDEX_PACK_KEY:
+            break
+        if is_fill_key(key) and not started:
+            # Заполнитель KAG сразу после пакета раздела не входит в HeaderByteCount
+            f.seek(length, os.SEEK_CUR)
+            continue
+        started = True
+        consumed += header_size + length
+        if key == INDEX_SEGMENT_KEY:
+            segment = f.read(length)
+            if len(segment) != length:
+                raise MxfValidationError(f'Сегмент индекса в разделе {offset} обрезан')
+            partition['index_segments'].append(dict(iter_local_set(segment)))
+        elif key.startswith(METADATA_SET_PREFIX):
+            data = f.read(length)
+            if len(data) != length:
+                raise MxfValidationError(f'Метаданные в разделе {offset} обрезаны')
+            set_type = int.from_bytes(key[13:15], 'big')
+            partition['metadata_sets'].append((set_type, dict(iter_local_set(data))))
+        else:
+            f.seek(length, os.SEEK_CUR)
+    return partition
+
+
+def read_random_index_pack(f, file_size):
+    '''Читает Random Index Pack в конце файла. Возвращает список смещений разделов или None.'''
+    if file_size < 20:
+        return None
+    f.seek(file_size - 4)
+    rip_length = struct.unpack('>I', f.read(4))[0]
+    if rip_length < 20 or rip_length > file_size:
+        return None
+    f.seek(file_size - rip_length)
+    if f.read(16) != RANDOM_INDEX_PACK_KEY:
+        return None
+    length, _ = read_ber_length(f)
+    value = f.read(length)
+    # Пары (BodySID 4 байта, смещение 8 байт), в конце - общая длина пакета
+    return [struct.unpack_from('>IQ', value, pos)[1]
+            for pos in range(0, len(value) - 4, 12)]
+
+
+def collect_partitions(f, file_size):
+    '''Находит все разделы файла, не сканируя эссенцию.'''
+    header_partition = read_partition(f, 0)
+    if header_partition['kind'] != PARTITION_HEADER:
+        raise MxfValidationError('Файл не начинается с раздела заголовка MXF')
+
+    offsets = read_random_index_pack(f, file_size)
+    if offsets is None:
+        # Без RIP идём по цепочке PreviousPartition от футера
+        footer_offset = header_partition['footer_partition']
+        if not footer_offset or footer_offset >= file_size:
+            raise MxfValidationError('Не найден раздел футера: файл, вероятно, обрезан')
+        offsets = []
+        offset = footer_offset
+        while offset and offset not in offsets:
+            offsets.append(offset)
+            offset = read_partition(f, offset)['previous_partition']
+
+    partitions = [header_partition]
+    for offset in sorted(set(offsets)):
+        if offset == 0:
+            continue
+        if offset >= file_size:
+            raise MxfValidationError(f'Раздел по смещению {offset} за концом файла: файл обрезан')
+        partitions.append(read_partition(f, offset))
+    return partitions
+
+
+def read_rational(data):
+    if len(data) < 8:
+        return None
+    return struct.unpack('>ii', data[:8])
+
+
+def read_uint(data):
+    return int.from_bytes(data, 'big') if data else None
+
+
+def parse_mxf(path):
+    '''Разбирает служебные структуры MXF и возвращает сводку о файле.'''
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        partitions = collect_partitions(f, file_size)
+
+    footer = [p for p in partitions if p['kind'] == PARTITION_FOOTER]
+    if not footer:
+        raise MxfValidationError('Раздел футера отсутствует: файл не был корректно закрыт')
+
+    # Берём метаданные из закрытого заголовка, иначе из футера
+    metadata_sets = []
+    for partition in [partitions[0]] + footer:
+        if partition['metadata_sets']:
+            metadata_sets = partition['metadata_sets']
+            if partition['status'] == PARTITION_STATUS_CLOSED_COMPLETE:
+                break
+
+    video_descriptors = [s for t, s in metadata_sets if t in VIDEO_DESCRIPTOR_TYPES]
+    sound_descriptors = [s for t, s in metadata_sets if t in SOUND_DESCRIPTOR_TYPES]
+
+    # Сегменты индекса повторяются в разных разделах - убираем дубликаты
+    index_spans = {}
+    for partition in partitions:
+        for segment in partition['index_segments']:
+            sid = read_uint(segment.get(TAG_INDEX_SID))
+            start = read_uint(segment.get(TAG_INDEX_START_POSITION))
+            duration = read_uint(segment.get(TAG_INDEX_DURATION))
+            if start is None or duration is None:
+                continue
+            key = (sid, start)
+            index_spans[key] = max(index_spans.get(key, 0), duration)
+
+    index_frames = None
+    if index_spans:
+        index_frames = max(start + duration for (_, start), duration in index_spans.items())
+
+    container_duration = None
+    edit_rate = None
+    stored_width = None
+    if video_descriptors:
+        descriptor = video_descriptors[0]
+        container_duration = read_uint(descriptor.get(TAG_CONTAINER_DURATION))
+        edit_rate = read_rational(descriptor.get(TAG_SAMPLE_RATE, b''))
+        stored_width = read_uint(descriptor.get(TAG_STORED_WIDTH))
+
+    return {
+        'file_size': file_size,
+        'partitions': len(partitions),
+        'header_closed': partitions[0]['status'] == PARTITION_STATUS_CLOSED_COMPLETE,
+        'video_descriptors': len(video_descriptors),
+        'audio_tracks': len(sound_descriptors),
+        'audio_channels': [read_uint(s.get(TAG_CHANNEL_COUNT)) for s in sound_descriptors],
+        'edit_rate': edit_rate,
+        'stored_width': stored_width,
+        'container_duration': container_duration,
+        'index_frames': index_frames,
+    }
+
+
+def detect_ts_packet_size(data):
+    '''Определяет размер пакета (188 для TS, 192 для M2TS/MTS) и смещение байта синхронизации.'''
+    for size, sync_offset in ((M2TS_PACKET_SIZE, 4), (TS_PACKET_SIZE, 0)):
+        if len(data) >= sync_offset + 2 * size and \
+                data[sync_offset] == TS_SYNC_BYTE and data[sync_offset + size] == TS_SYNC_BYTE:
+            return size, sync_offset
+    return None, None
+
+
+def iter_pcr(data, packet_size, sync_offset):
+    '''Перебирает значения PCR (в тактах 27 МГц) в блоке транспортного потока.'''
+    for pos in range(0, len(data) - packet_size + 1, packet_size):
+        packet = data[pos + sync_offset:pos + sync_offset + TS_PACKET_SIZE]
+        if packet[0] != TS_SYNC_BYTE or not packet[3] & 0x20:
+            continue
+        if packet[4] < 7 or not packet[5] & 0x10:
+            continue
+        b = packet[6:12]
+        base = (b[0] << 25) | (b[1] << 17) | (b[2] << 9) | (b[3] << 1) | (b[4] >> 7)
+        extension = ((b[4] & 0x01) << 8) | b[5]
+        yield base * 300 + extension
+
+
+def read_mts_duration(path):
+    '''Длительность клипа MTS в секундах по первому и последнему PCR.
+
+    Читаются только первые и последние PCR_SCAN_BYTES байт файла.'''
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(PCR_SCAN_BYTES)
+        packet_size, sync_offset = detect_ts_packet_size(head)
+        if packet_size is None:
+            raise MxfValidationError(f'{os.path.basename(path)}: не транспортный поток MPEG-TS')
+        first_pcr = next(iter_pcr(head, packet_size, sync_offset), None)
+
+        # Хвост читаем с границы пакета
+        packets_total = file_size // packet_size
+        tail_start = max(0, packets_total * packet_size - PCR_SCAN_BYTES)
+        tail_start -= tail_start % packet_size
+        f.seek(tail_start)
+        tail = f.read(PCR_SCAN_BYTES)
+        last_pcr = None
+        for last_pcr in iter_pcr(tail, packet_size, sync_offset):
+            pass
+
+    if first_pcr is None or last_pcr is None:
+        raise MxfValidationError(f'{os.path.basename(path)}: в потоке нет PCR')
+    return ((last_pcr - first_pcr) % PCR_WRAP) / PCR_CLOCK
+
+
+def expected_frame_count(source_files, fps):
+    '''Ожидаемое число кадров склейки клипов MTS при заданной частоте кадров.'''
+    return round(sum(read_mts_duration(path) for path in source_files) * fps)
+
+
+def validate_mxf(path, expected_frames=None, audio_tracks=None, edit_rate=None, tolerance=0):
+    '''Проверяет файл MXF после кодирования.
+
+    Возвращает (успех, сообщение) - как сигналы finished у потоков.'''
+    name = os.path.basename(path)
+    try:
+        info = parse_mxf(path)
+    except MxfValidationError as e:
+        return False, f'Проверка {name} не пройдена: {e}'
+    except OSError as e:
+        return False, f'Не удалось прочитать {name} для проверки: {e}'
+
+    errors = []
+    if not info['header_closed']:
+        errors.append('раздел заголовка не закрыт')
+    if not info['video_descriptors']:
+        errors.append('нет дескриптора видео')
+    if edit_rate and info['edit_rate'] and tuple(info['edit_rate']) != tuple(edit_rate):
+        errors.append(f"частота кадров {info['edit_rate'][0]}/{info['edit_rate'][1]}, "
+                      f"ожидалась {edit_rate[0]}/{edit_rate[1]}")
+    if audio_tracks is not None and info['audio_tracks'] != audio_tracks:
+        errors.append(f"звуковых дорожек {info['audio_tracks']}, ожидалось {audio_tracks}")
+
+    frames = info['index_frames'] if info['index_frames'] is not None else info['container_duration']
+    if frames is None:
+        errors.append('не удалось определить число кадров (нет индекса и длительности)')
+    else:
+        if info['index_frames'] is not None and info['container_duration'] and \
+                info['index_frames'] != info['container_duration']:
+            errors.append(f"индекс содержит {info['index_frames']} кадров, "
+                          f"а заголовок - {info['container_duration']}")
+        if expected_frames is not None and abs(frames - expected_frames) > tolerance:
+            errors.append(f'кадров {frames}, ожидалось {expected_frames}')
+
+    if errors:
+        return False, f'Проверка {name} не пройдена: ' + '; '.join(errors)
+    return True, f'Проверка {name} пройдена: {frames} кадров, звуковых дорожек {info["audio_tracks"]}.'
@@ -0,0 +1,92 @@
+import os
+import errno
+import itertools
+
+import pytest
+
+import encode_cache
+from encode_cache import EncodeCache
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_key_depends_on_clip_order_and_profile(tmp_path):
+    cache = EncodeCache(str(tmp_path / 'cache'), 10 ** 9)
+    first = write(tmp_path / '0000.MTS', b'\x47' * 1000)
+    second = write(tmp_path / '0001.MTS', b'\x48' * 1000)
+
+    key = cache.make_key([first, second], ['ffmpeg', '-b', '50M'])
+    assert key == cache.make_key([first, second], ['ffmpeg', '-b', '50M'])
+    assert key != cache.make_key([second, first], ['ffmpeg', '-b', '50M'])
+    assert key != cache.make_key([first, second], ['ffmpeg', '-b', '25M'])
+
+
+def test_hit_restores_identical_bytes(tmp_path):
+    cache = EncodeCache(str(tmp_path / 'cache'), 10 ** 9)
+    data = os.urandom(64 * 1024)
+    output = write(tmp_path / 'story.mxf', data)
+
+    assert cache.fetch('key', str(tmp_path / 'miss.mxf')) is None
+    cache.store('key', output)
+    restored = tmp_path / 'restored.mxf'
+    assert cache.fetch('key', str(restored), str(tmp_path / 'out' / 'story.mxf')) is not None
+    assert restored.read_bytes() == data
+    # Выдача на том же томе не делит данные с записью кэша
+    assert os.stat(restored).st_nlink == 1
+
+
+def test_hardlink_is_not_safe_on_same_device(tmp_path):
+    cache = EncodeCache(str(tmp_path / 'cache'), 10 ** 9)
+    os.makedirs(cache.cache_dir)
+    (tmp_path / 'out').mkdir()
+
+    assert not cache.hardlink_is_safe(str(tmp_path / 'out' / 'story.mxf'))
+    assert not cache.hardlink_is_safe(None)
+
+
+def test_evict_removes_least_recently_touched(tmp_path, monkeypatch):
+    clock = itertools.count(10 ** 18, 10 ** 9)
+    monkeypatch.setattr(encode_cache.time, 'time_ns', lambda: next(clock))
+    cache = EncodeCache(str(tmp_path / 'cache'), 250)
+    output = write(tmp_path / 'story.mxf', b'x' * 100)
+
+    cache.store('a', output)
+    cache.store('b', output)
+    cache.touch(cache.entry_path('a'))
+    cache.store('c', output)
+
+    assert sorted(os.listdir(cache.cache_dir)) == ['a.mxf', 'c.mxf']
+
+
+def test_failed_store_leaves_no_temp_file(tmp_path, monkeypatch):
+    cache = EncodeCache(str(tmp_path / 'cache'), 10 ** 9)
+    output = write(tmp_path / 'story.mxf', b'x' * 1000)
+
+    def copy_without_space(src, dst):
+        with open(dst, 'wb') as f:
+            f.write(b'x' * 10)
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    def no_reflink(src, dst):
+        raise OSError(errno.EOPNOTSUPP, 'reflink не поддерживается')
+    monkeypatch.setattr(encode_cache, 'reflink', no_reflink)
+    monkeypatch.setattr(encode_cache.shutil, 'copy2', copy_without_space)
+
+    with pytest.raises(OSError):
+        cache.store('key', output)
+    assert os.listdir(cache.cache_dir) == []
+
+
+def test_evict_removes_stale_temp_files(tmp_path):
+    cache = EncodeCache(str(tmp_path / 'cache'), 10 ** 9)
+    os.makedirs(cache.cache_dir)
+    stale = write(tmp_path / 'cache' / 'old.mxf.1.2.tmp', b'x')
+    os.utime(stale, (0, 0))
+    fresh = write(tmp_path / 'cache' / 'new.mxf.1.3.tmp', b'x')
+
+    cache.evict()
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
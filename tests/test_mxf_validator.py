@@ -0,0 +1,103 @@
+import struct
+
+import ingest_pipeline
+import mxf_validator as mxf
+
+
+PRIMER_PACK_KEY = bytes.fromhex('060e2b34020501010d01020101050100')
+FILL_KEY = bytes.fromhex('060e2b34010101020301021001000000')
+ESSENCE_KEY = bytes.fromhex('060e2b34010201010d01030115010500')
+
+
+def klv(key, value):
+    return key + b'\x83' + len(value).to_bytes(3, 'big') + value
+
+
+def local_set(items):
+    return b''.join(struct.pack('>HH', tag, len(value)) + value for tag, value in items)
+
+
+def partition_pack(kind, this, footer, header_bytes, index_bytes):
+    key = mxf.PARTITION_KEY_PREFIX + bytes([kind, mxf.PARTITION_STATUS_CLOSED_COMPLETE, 0])
+    value = (struct.pack('>HHI', 1, 3, 512)
+             + struct.pack('>QQQQQ', this, 0, footer, header_bytes, index_bytes)
+             + struct.pack('>IQI', 1, 0, 1) + b'\0' * 16 + struct.pack('>II', 0, 16))
+    return klv(key, value)
+
+
+def build_mxf(frames=250, audio_tracks=8, with_footer=True):
+    '''Минимальный OP1a: заголовок с Primer Pack и дескрипторами, эссенция, футер с индексом, RIP.'''
+    metadata = klv(PRIMER_PACK_KEY, struct.pack('>II', 0, 18))
+    metadata += klv(mxf.METADATA_SET_PREFIX + bytes([0x01, 0x51, 0]), local_set([
+        (mxf.TAG_SAMPLE_RATE, struct.pack('>ii', 25, 1)),
+        (mxf.TAG_CONTAINER_DURATION, struct.pack('>q', frames)),
+    ]))
+    for _ in range(audio_tracks):
+        metadata += klv(mxf.METADATA_SET_PREFIX + bytes([0x01, 0x48, 0]),
+                        local_set([(mxf.TAG_CHANNEL_COUNT, struct.pack('>I', 1))]))
+    index = klv(mxf.INDEX_SEGMENT_KEY, local_set([
+        (mxf.TAG_INDEX_SID, struct.pack('>I', 1)),
+        (mxf.TAG_INDEX_START_POSITION, struct.pack('>q', 0)),
+        (mxf.TAG_INDEX_DURATION, struct.pack('>q', frames)),
+    ]))
+    fill = klv(FILL_KEY, b'\0' * 8)
+    essence = klv(ESSENCE_KEY, b'\0' * 1000)
+
+    header_size = len(partition_pack(mxf.PARTITION_HEADER, 0, 0, 0, 0)) + len(fill) + len(metadata)
+    footer_offset = header_size + len(essence)
+    data = partition_pack(mxf.PARTITION_HEADER, 0, footer_offset, len(metadata), 0)
+    data += fill + metadata + essence
+    if not with_footer:
+        return data
+
+    data += partition_pack(mxf.PARTITION_FOOTER, footer_offset, footer_offset, 0, len(index)) + index
+    rip_value = struct.pack('>IQ', 1, 0) + struct.pack('>IQ', 0, footer_offset)
+    rip_size = 16 + 4 + len(rip_value) + 4
+    return data + klv(mxf.RANDOM_INDEX_PACK_KEY, rip_value + struct.pack('>I', rip_size))
+
+
+def write(tmp_path, data):
+    path = tmp_path / 'story.mxf'
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_valid_file(tmp_path):
+    path = write(tmp_path, build_mxf())
+
+    info = mxf.parse_mxf(path)
+    assert info['video_descriptors'] == 1
+    assert info['audio_tracks'] == 8
+    assert info['index_frames'] == 250
+    assert info['container_duration'] == 250
+
+    valid, message = mxf.validate_mxf(path, expected_frames=250, audio_tracks=8, edit_rate=(25, 1))
+    assert valid, message
+
+
+def test_truncated_file(tmp_path):
+    path = write(tmp_path, build_mxf(with_footer=False)[:-300])
+
+    valid, message = mxf.validate_mxf(path, expected_frames=250, audio_tracks=8)
+    assert not valid
+    assert 'обрезан' in message
+
+
+def test_wrong_tracks_and_frames(tmp_path):
+    path = write(tmp_path, build_mxf(frames=200, audio_tracks=4))
+
+    valid, message = mxf.validate_mxf(path, expected_frames=250, audio_tracks=8, tolerance=2)
+    assert not valid
+    assert 'звуковых дорожек 4, ожидалось 8' in message
+    assert 'кадров 200, ожидалось 250' in message
+
+
+def test_unreadable_source_fails_validation(tmp_path):
+    path = write(tmp_path, build_mxf())
+    source = tmp_path / '0000.mts'
+    source.write_bytes(b'\0' * 4096) # Не транспортный поток: длительность не определить
+
+    valid, message = ingest_pipeline.validate_output(path, [str(source)])
+    assert not valid
+    assert 'не удалось определить длительность' in message
+    assert 'не транспортный поток' in message
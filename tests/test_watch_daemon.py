@@ -0,0 +1,64 @@
+import os
+
+import watch_daemon
+
+
+class RecordingExecutor:
+    '''Пул заданий, который только запоминает отправленные задания.'''
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        self.jobs.append(args)
+
+
+def make_daemon(tmp_path, drops):
+    config = tmp_path / 'config.ini'
+    config.write_text(f'[settings]\n'
+                      f'ingest_root_path = {tmp_path / "ingest"}\n'
+                      f'mxf_target_folder = {tmp_path / "out"}\n'
+                      f'[watch]\n'
+                      f'folders = {drops}\n'
+                      f'stable_seconds = 15\n', encoding='utf-8')
+    daemon = watch_daemon.WatchDaemon(str(config))
+    daemon.executor = RecordingExecutor()
+    return daemon
+
+
+def test_in_place_write_with_final_size_delays_ingest(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(watch_daemon.time, 'monotonic', lambda: now[0])
+    drops = tmp_path / 'drops'
+    drops.mkdir()
+    os.utime(drops, ns=(0, 0))
+    daemon = make_daemon(tmp_path, drops)
+    watcher = watch_daemon.PollingWatcher([str(drops)])
+
+    # Копирование по SMB: файл сразу получает итоговый размер, данные дописываются позже
+    stream_dir = drops / 'Иванов' / 'Пожар' / 'PRIVATE' / 'AVCHD' / 'BDMV' / 'STREAM'
+    stream_dir.mkdir(parents=True)
+    clip = stream_dir / '0000.MTS'
+    with open(clip, 'wb') as f:
+        f.truncate(1024 * 1024)
+    os.utime(clip, ns=(1, 1))
+    for directory in watcher.poll(0):
+        daemon.consider(directory)
+    assert str(stream_dir) in daemon.pending
+
+    # Запись данных не меняет размер файла и время изменения папки
+    now[0] += 10
+    with open(clip, 'r+b') as f:
+        f.write(b'\x47' * 4096)
+    os.utime(clip, ns=(2, 2))
+    assert str(stream_dir) not in watcher.poll(0)
+    daemon.check_pending()
+
+    # Размер не менялся уже stable_seconds, но файл ещё пишется - инжест не начинается
+    now[0] += 10
+    daemon.check_pending()
+    assert daemon.executor.jobs == []
+
+    now[0] += 10
+    daemon.check_pending()
+    assert daemon.executor.jobs == [(str(stream_dir), ['0000.MTS'])]
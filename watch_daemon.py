@@ -0,0 +1,448 @@
+'''Режим наблюдения за папками (без графического интерфейса).
+
+Следит за папками, куда выездные группы кладут папки AVCHD STREAM,
+дожидается, пока размеры файлов MTS перестанут меняться, и запускает
+тот же конвейер, что и форма: копирование, кодирование ffmpeg, проверка mxf и перенос.
+
+На Linux изменения отслеживаются через inotify, на остальных системах -
+опросом времени изменения уже известных папок (без повторного обхода всего дерева).
+
+Запуск: python watch_daemon.py [путь к config.ini]'''
+
+import os
+import re
+import sys
+import time
+import ctypes
+import errno
+import select
+import struct
+import tempfile
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import metrics
+import ingest_pipeline
+from encode_cache import EncodeCache
+
+
+# Части пути AVCHD, которые отбрасываются при определении корня поступления
+AVCHD_PATH_PARTS = {'private', 'avchd', 'bdmv', 'stream'}
+
+# Флаги inotify (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+def log(message):
+    '''Вывод сообщения демона с отметкой времени.'''
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {message}", flush=True)
+
+
+def walk_directories(root):
+    '''Все папки поддерева, включая сам корень.'''
+    directories = []
+    for dirpath, _, _ in os.walk(root):
+        directories.append(dirpath)
+    return directories
+
+
+def reserve_path(path, create):
+    '''Атомарно занимает свободное имя, добавляя суффикс " (2)", " (3)"..., если путь занят.
+
+    create(candidate) должен создать путь и выбросить FileExistsError, если он уже существует.'''
+    base, ext = os.path.splitext(path)
+    candidate = path
+    counter = 1
+    while True:
+        try:
+            create(candidate)
+            return candidate
+        except FileExistsError:
+            counter += 1
+            candidate = f'{base} ({counter}){ext}'
+
+
+class InotifyWatcher:
+    '''Наблюдение за деревьями папок через inotify (только Linux).'''
+
+    def __init__(self, roots):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 завершился с ошибкой')
+        self.roots = roots
+        self.watches = {} # wd -> путь к папке (при переносе папки wd сохраняется, путь обновляется)
+        for root in roots:
+            self.add_tree(root)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                log(f'Достигнут предел fs.inotify.max_user_watches, папка не отслеживается: {path}')
+            else:
+                log(f'Не удалось отслеживать {path}: {os.strerror(error)}')
+            return
+        self.watches[wd] = path
+
+    @property
+    def directories(self):
+        return set(self.watches.values())
+
+    def add_tree(self, root):
+        '''Ставит наблюдение на поддерево и возвращает его папки.'''
+        directories = walk_directories(root)
+        for path in directories:
+            self.add_watch(path)
+        return directories
+
+    def poll(self, timeout):
+        '''Ждёт событий до timeout секунд. Возвращает множество изменившихся папок.'''
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos + INOTIFY_EVENT.size <= len(data):
+                wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                name = os.fsdecode(data[pos:pos + name_length].rstrip(b'\0'))
+                pos += name_length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Очередь переполнена - события потеряны, перечитываем известные папки
+                    log('Очередь inotify переполнена, проверяем все папки.')
+                    changed.update(self.directories)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                changed.add(directory)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    # Новая папка (или перенесённая целиком) - файлы в ней событий не дадут
+                    changed.update(self.add_tree(os.path.join(directory, name)))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    '''Наблюдение опросом: проверяется только время изменения уже известных папок.'''
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.mtimes = {} # путь к папке -> время изменения
+        for root in roots:
+            self.add_tree(root)
+
+    @property
+    def directories(self):
+        return set(self.mtimes)
+
+    def add_tree(self, root):
+        directories = walk_directories(root)
+        for path in directories:
+            try:
+                self.mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+        return directories
+
+    def poll(self, timeout):
+        '''Спит timeout секунд и возвращает папки, у которых изменилось содержимое.'''
+        time.sleep(timeout)
+        changed = set()
+        for path, mtime in list(self.mtimes.items()):
+            try:
+                current = os.stat(path).st_mtime_ns
+            except OSError:
+                self.mtimes.pop(path, None)
+                continue
+            if current == mtime:
+                continue
+            self.mtimes[path] = current
+            changed.add(path)
+            # Ищем новые подпапки только в изменившейся папке
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir() and entry.path not in self.mtimes:
+                    changed.update(self.add_tree(entry.path))
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(roots):
+    '''inotify на Linux, опрос на остальных системах.'''
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            log(f'inotify недоступен ({e}), используем опрос папок.')
+    return PollingWatcher(roots)
+
+
+class WatchDaemon:
+    '''Находит готовые поступления STREAM и запускает для них инжест.'''
+
+    def __init__(self, config_path='config.ini'):
+        self.config = configparser.ConfigParser(interpolation=None)
+        self.config.read(config_path, encoding='utf-8')
+        if 'settings' not in self.config or 'watch' not in self.config:
+            raise ValueError(f'В {config_path} должны быть разделы [settings] и [watch]')
+
+        settings = self.config['settings']
+        self.ingest_root_path = settings.get('ingest_root_path')
+        self.mxf_target_folder = settings.get('mxf_target_folder')
+        self.ffmpeg_path = settings.get('ffmpeg_path', ingest_pipeline.FFMPEG_PATH)
+        if not self.ingest_root_path or not self.mxf_target_folder:
+            raise ValueError('В config.ini должны быть указаны ingest_root_path и mxf_target_folder')
+        self.encode_cache = EncodeCache.from_settings(settings, self.ingest_root_path)
+
+        watch = self.config['watch']
+        self.folders = [os.path.abspath(f.strip()) for f in watch.get('folders', '').split(',') if f.strip()]
+        if not self.folders:
+            raise ValueError('В разделе [watch] не указаны папки (folders)')
+        self.stable_seconds = watch.getfloat('stable_seconds', 15)
+        self.poll_interval = watch.getfloat('poll_interval', 2)
+        self.max_jobs = watch.getint('max_jobs', 2)
+        self.process_existing = watch.getboolean('process_existing', False)
+        self.name_pattern = re.compile(watch.get('name_pattern', r'^(?P<journalist>[^/]+)/(?P<story>[^/]+)'))
+        self.default_journalist = watch.get('default_journalist', 'Корреспондент')
+        self.default_story = watch.get('default_story', '')
+
+        self.pending = {} # папка STREAM -> [снимок файлов, время последнего изменения]
+        self.processed = {} # папка STREAM -> снимок, с которым она ушла в работу
+        self.active = set() # папки STREAM, по которым идёт инжест
+        self.queued = 0 # Отправленные в пул задания, которые ещё не начались
+        self.reserved_targets = set() # Имена mxf, занятые заданиями до окончания переноса
+        self.lock = threading.Lock()
+        self.executor = None
+        self.watcher = None
+
+    def snapshot(self, stream_dir):
+        '''Имена, размеры и время изменения файлов MTS в папке.
+
+        Копирование по SMB часто сразу задаёт итоговый размер файла и затем заполняет данные,
+        поэтому незавершённую запись выдаёт только время изменения.'''
+        result = []
+        for filename in ingest_pipeline.list_mts_files(stream_dir):
+            stat = os.stat(os.path.join(stream_dir, filename))
+            result.append((filename, stat.st_size, stat.st_mtime_ns))
+        return tuple(result)
+
+    def consider(self, directory):
+        '''Отмечает папку STREAM как ожидающую окончания записи файлов.'''
+        if os.path.basename(directory).lower() != 'stream':
+            return
+        try:
+            snapshot = self.snapshot(directory)
+        except OSError:
+            self.pending.pop(directory, None)
+            return
+        if not snapshot or self.processed.get(directory) == snapshot:
+            return
+        # Любое событие в папке сбрасывает отсчёт стабильности
+        self.pending[directory] = [snapshot, time.monotonic()]
+
+    def check_pending(self):
+        '''Запускает инжест для папок, файлы в которых не менялись stable_seconds.'''
+        now = time.monotonic()
+        for stream_dir, (snapshot, changed_at) in list(self.pending.items()):
+            try:
+                current = self.snapshot(stream_dir)
+            except OSError:
+                del self.pending[stream_dir]
+                continue
+            if current != snapshot:
+                self.pending[stream_dir] = [current, now]
+                continue
+            if now - changed_at < self.stable_seconds:
+                continue
+            with self.lock:
+                if stream_dir in self.active:
+                    continue # Дождёмся окончания текущего инжеста этой папки
+                self.active.add(stream_dir)
+                self.queued += 1
+            del self.pending[stream_dir]
+            self.processed[stream_dir] = current
+            files = [filename for filename, _, _ in current]
+            self.executor.submit(self.run_job, stream_dir, files)
+        self.update_queue_depth()
+
+    def update_queue_depth(self):
+        with self.lock:
+            metrics.QUEUE_DEPTH.set(len(self.pending) + self.queued)
+
+    def resolve_names(self, stream_dir):
+        '''Определяет журналиста и сюжет по пути поступления и правилу name_pattern.'''
+        drop_root = stream_dir
+        while os.path.basename(drop_root).lower() in AVCHD_PATH_PARTS:
+            drop_root = os.path.dirname(drop_root)
+
+        relative = ''
+        for folder in self.folders:
+            if os.path.commonpath([folder, drop_root]) == folder:
+                relative = os.path.relpath(drop_root, folder)
+                break
+        relative = '' if relative == '.' else relative.replace(os.sep, '/')
+
+        match = self.name_pattern.search(relative)
+        groups = match.groupdict() if match else {}
+        journalist = (groups.get('journalist') or self.default_journalist).strip()
+        story = (groups.get('story') or self.default_story or os.path.basename(drop_root)).strip()
+        story = ingest_pipeline.INVALID_NAME_CHARS.sub('_', story)
+        return journalist, story
+
+    def reserve_target(self, path):
+        '''Занимает имя mxf в памяти до конца задания (вызывать под self.lock).
+
+        В mxf_target_folder ничего не создаётся: оттуда забирают материал монтажёры.'''
+        if path in self.reserved_targets or os.path.exists(path):
+            raise FileExistsError(path)
+        self.reserved_targets.add(path)
+
+    def run_job(self, stream_dir, files):
+        '''Копирование, кодирование, проверка и перенос одного поступления.'''
+        concat_file_path = None
+        target_path = None
+        started = time.monotonic()
+        result = 'failure'
+        with self.lock:
+            self.queued -= 1
+        self.update_queue_depth()
+        try:
+            journalist, story = self.resolve_names(stream_dir)
+            day_month = datetime.now().strftime('%d%m')
+            folder_name = ingest_pipeline.make_folder_name(day_month, journalist, story)
+            os.makedirs(self.ingest_root_path, exist_ok=True)
+            os.makedirs(self.mxf_target_folder, exist_ok=True)
+            # Параллельные поступления одного сюжета (несколько карт) получают разные имена:
+            # папка занимается атомарно (mkdir), имя mxf - под self.lock до окончания переноса
+            output_filename = f'{story}.mxf'
+            with self.lock:
+                dest_folder = reserve_path(os.path.join(self.ingest_root_path, folder_name), os.mkdir)
+                target_path = reserve_path(os.path.join(self.mxf_target_folder, output_filename),
+                                           self.reserve_target)
+            log(f'Инжест {stream_dir} -> {dest_folder} ({len(files)} файлов)')
+
+            ingest_pipeline.copy_files(files, stream_dir, dest_folder)
+
+            # Отдельный список склейки на каждое поступление - задания идут параллельно
+            fd, concat_file_path = tempfile.mkstemp(prefix='concat_', suffix='.txt')
+            os.close(fd)
+            ingest_pipeline.write_concat_file(concat_file_path, dest_folder, files)
+
+            output_file_path = os.path.join(dest_folder, output_filename)
+            ffmpeg_cmd = ingest_pipeline.build_ffmpeg_cmd(concat_file_path, output_file_path, self.ffmpeg_path)
+
+            source_files = [os.path.join(dest_folder, filename) for filename in files]
+            cache_key, cache_method = ingest_pipeline.fetch_cached_output(
+                self.encode_cache, source_files, self.ffmpeg_path, output_file_path, target_path)
+            if cache_method:
+                log(f'Результат для {stream_dir} взят из кэша кодирования ({cache_method})')
+            else:
+                ingest_pipeline.remove_stale_output(output_file_path)
+                returncode, stderr = ingest_pipeline.run_ffmpeg(ffmpeg_cmd)
+                if returncode != 0:
+                    log(f'FFmpeg вернул ошибку для {stream_dir}:\n{stderr}')
+                    return
+
+            valid, message = ingest_pipeline.validate_output(output_file_path, source_files)
+            log(message)
+            if not valid:
+                return
+            if not cache_method:
+                ingest_pipeline.store_cached_output(self.encode_cache, cache_key, output_file_path, target_path)
+
+            with self.lock:
+                if os.path.exists(target_path):
+                    # Файл с этим именем появился в mxf_target_folder за время задания - не перезаписываем
+                    self.reserved_targets.discard(target_path)
+                    target_path = reserve_path(os.path.join(self.mxf_target_folder, output_filename),
+                                               self.reserve_target)
+            ingest_pipeline.move_output(output_file_path, target_path)
+            result = 'success'
+            log(f'Готово: {target_path}')
+        except Exception as e:
+            log(f'Ошибка инжеста {stream_dir}: {e}')
+        finally:
+            if concat_file_path and os.path.exists(concat_file_path):
+                os.remove(concat_file_path)
+            with self.lock:
+                self.active.discard(stream_dir)
+                self.reserved_targets.discard(target_path)
+            metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='total')
+            metrics.JOBS_TOTAL.inc(result=result)
+
+    def run(self):
+        metrics.start_from_config(self.config)
+        self.watcher = create_watcher(self.folders)
+        log(f'Наблюдение ({type(self.watcher).__name__}) за папками: {", ".join(self.folders)}')
+
+        for directory in self.watcher.directories:
+            if self.process_existing:
+                self.consider(directory)
+            elif os.path.basename(directory).lower() == 'stream':
+                # Уже лежащие поступления считаем обработанными
+                try:
+                    self.processed[directory] = self.snapshot(directory)
+                except OSError:
+                    pass
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+        try:
+            while True:
+                for directory in self.watcher.poll(self.poll_interval):
+                    self.consider(directory)
+                self.check_pending()
+        except KeyboardInterrupt:
+            log('Остановка: ждём завершения текущих заданий...')
+        finally:
+            # Задания из очереди, которые ещё не начались, отменяем - ждём только текущие
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.watcher.close()
+
+
+if __name__ == '__main__':
+    config_path = sys.argv[1] if len(sys.argv) > 1 else 'config.ini'
+    try:
+        daemon = WatchDaemon(config_path)
+    except ValueError as e:
+        log(f'Ошибка конфигурации: {e}')
+        sys.exit(1)
+    daemon.run()